@@ -64,7 +64,7 @@ class BaseInstance3DBoxes(object):
         Returns:
             torch.Tensor: A vector with volume of each box.
         """
-        return self.tensor[:, 3] * self.tensor[:, 4] * self.tensor[:, 5]
+        return self.tensor[:, 3:6].prod(dim=1)
 
     @property
     def dims(self):
@@ -200,12 +200,14 @@ class BaseInstance3DBoxes(object):
             torch.Tensor: A binary vector indicating whether each box is \
                 inside the reference range.
         """
-        in_range_flags = ((self.tensor[:, 0] > box_range[0])
-                          & (self.tensor[:, 1] > box_range[1])
-                          & (self.tensor[:, 2] > box_range[2])
-                          & (self.tensor[:, 0] < box_range[3])
-                          & (self.tensor[:, 1] < box_range[4])
-                          & (self.tensor[:, 2] < box_range[5]))
+        if isinstance(box_range, torch.Tensor):
+            box_range = box_range.to(self.tensor)
+        else:
+            box_range = self.tensor.new_tensor(box_range)
+        # compare the contiguous centers against both bounds at once
+        centers = self.tensor[:, :3]
+        in_range_flags = ((centers > box_range[:3])
+                          & (centers < box_range[3:6])).all(dim=1)
         return in_range_flags
 
     @abstractmethod
@@ -271,12 +273,7 @@ class BaseInstance3DBoxes(object):
             torch.Tensor: A binary vector which represents whether each \
                 box is empty (False) or non-empty (True).
         """
-        box = self.tensor
-        size_x = box[..., 3]
-        size_y = box[..., 4]
-        size_z = box[..., 5]
-        keep = ((size_x > threshold)
-                & (size_y > threshold) & (size_z > threshold))
+        keep = (self.tensor[:, 3:6] > threshold).all(dim=1)
         return keep
 
     def __getitem__(self, item):
@@ -1,9 +1,239 @@
+import math
 import numpy as np
+import threading
 import torch
 
 from mmdet3d.ops import points_in_boxes_batch
 from .base_box3d import BaseInstance3DBoxes
-from .utils import limit_period, rotation_3d_in_axis
+
+# normalized corners relative to the origin (0.5, 0.5, 0), cached per
+# (device, dtype) since they are constant
+_CORNERS_NORM_CACHE = {}
+# signs multiplied to boxes when flipping them, cached per
+# (bev_direction, with_yaw, box_dim, device, dtype)
+_FLIP_SIGN_CACHE = {}
+# index tensors used to gather columns of boxes, cached per
+# (columns, device)
+_INDEX_CACHE = {}
+# workspace of temporary results reused by the NumPy rotation of boxes in
+# each thread (e.g., the data loading workers)
+_ROT_WS = threading.local()
+
+
+def _get_index(columns, device):
+    """Get the cached index tensor of the given columns.
+
+    Args:
+        columns (tuple[int]): Indices of the columns to gather.
+        device (:obj:`torch.device`): Device of the index tensor.
+
+    Returns:
+        torch.Tensor: Index tensor of the columns on the device.
+    """
+    key = (columns, device)
+    index = _INDEX_CACHE.get(key)
+    if index is None:
+        index = torch.tensor(columns, dtype=torch.long, device=device)
+        _INDEX_CACHE[key] = index
+    return index
+
+
+@torch.jit.script
+def _gravity_center_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    """Scripted computation of the gravity centers of boxes.
+
+    Args:
+        tensor (torch.Tensor): Boxes in shape (N, box_dim).
+
+    Returns:
+        torch.Tensor: Gravity centers of boxes in shape (N, 3).
+    """
+    return torch.stack(
+        (tensor[:, 0], tensor[:, 1], tensor[:, 2] + tensor[:, 5] * 0.5), dim=1)
+
+
+@torch.jit.script
+def _corners_tensor(tensor: torch.Tensor,
+                    corners_norm: torch.Tensor) -> torch.Tensor:
+    """Scripted computation of the corners of boxes.
+
+    Args:
+        tensor (torch.Tensor): Boxes in shape (N, box_dim).
+        corners_norm (torch.Tensor): Normalized corners in shape (8, 3).
+
+    Returns:
+        torch.Tensor: Corners of each box with size (N, 8, 3).
+    """
+    # (N, 1, 3) * (8, 3) broadcasts to the (N, 8, 3) corner offsets
+    offsets = tensor[:, 3:6].unsqueeze(1) * corners_norm
+
+    # rotate around z axis analytically, which is equivalent to
+    # rotation_3d_in_axis(offsets, yaw, axis=2), and then assemble
+    # the translated corners with a single stack
+    rot_sin = torch.sin(tensor[:, 6:7])
+    rot_cos = torch.cos(tensor[:, 6:7])
+    offset_x = offsets[:, :, 0]
+    offset_y = offsets[:, :, 1]
+    offset_z = offsets[:, :, 2]
+    corners = torch.stack(
+        (tensor[:, 0:1] + offset_x * rot_cos + offset_y * rot_sin,
+         tensor[:, 1:2] - offset_x * rot_sin + offset_y * rot_cos,
+         tensor[:, 2:3] + offset_z),
+        dim=-1)
+    return corners
+
+
+@torch.jit.script
+def _nearest_bev_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    """Scripted computation of the BEV boxes without rotation.
+
+    The BEV centers, sizes and rotations are read from the boxes
+    directly, so the XYWHR BEV boxes are not gathered first.
+
+    Args:
+        tensor (torch.Tensor): Boxes in shape (N, box_dim).
+
+    Returns:
+        torch.Tensor: BEV boxes without rotation in shape (N, 4).
+    """
+    # convert the rotation to a valid range, the same as
+    # torch.abs(limit_period(rotations, 0.5, np.pi))
+    rotations = tensor[:, 6]
+    normed_rotations = torch.abs(rotations -
+                                 torch.floor(rotations / math.pi + 0.5) *
+                                 math.pi)
+
+    # swap the sizes of boxes that are closer to the y axis, blending the
+    # sizes arithmetically by a 0/1 mask instead of selecting them
+    swap_mask = (normed_rotations > math.pi / 4).to(tensor.dtype).unsqueeze(-1)
+    centers = tensor[:, 0:2]
+    dims = tensor[:, 3:5]
+    dims = dims * (1 - swap_mask) + dims.flip([-1]) * swap_mask
+
+    half_dims = dims * 0.5
+    bev_boxes = torch.cat([centers - half_dims, centers + half_dims], dim=-1)
+    return bev_boxes
+
+
+@torch.jit.script
+def _rotate_points_z_(points: torch.Tensor, rot_cos: torch.Tensor,
+                      rot_sin: torch.Tensor) -> None:
+    """Scripted in-place rotation of points around z axis.
+
+    This is equivalent to ``points[:, :3] @ rot_mat_T`` but only updates
+    x and y since z is unchanged.
+
+    Args:
+        points (torch.Tensor): Points in shape (N, C), where C >= 3.
+        rot_cos (torch.Tensor): Cosine of the rotation angle.
+        rot_sin (torch.Tensor): Sine of the rotation angle.
+    """
+    x = points[:, 0].clone()
+    points[:, 0] = x * rot_cos - points[:, 1] * rot_sin
+    points[:, 1] = x * rot_sin + points[:, 1] * rot_cos
+
+
+@torch.jit.script
+def _rotate_tensor(tensor: torch.Tensor, angle: torch.Tensor,
+                   with_yaw: bool) -> torch.Tensor:
+    """Scripted in-place rotation of boxes around z axis.
+
+    Args:
+        tensor (torch.Tensor): Boxes in shape (N, box_dim).
+        angle (torch.Tensor): Rotation angle.
+        with_yaw (bool): Whether the boxes are with yaw rotation. If False,
+            the sizes of the boxes are updated to the axis-aligned extents
+            of the rotated boxes.
+
+    Returns:
+        torch.Tensor: Transposed rotation matrix in shape (3, 3).
+    """
+    rot_sin = torch.sin(angle)
+    rot_cos = torch.cos(angle)
+    zero = torch.zeros_like(rot_cos)
+    one = torch.ones_like(rot_cos)
+    # stack the transposed rotation matrix on the device of the boxes
+    rot_mat_T = torch.stack([
+        torch.stack([rot_cos, rot_sin, zero]),
+        torch.stack([-rot_sin, rot_cos, zero]),
+        torch.stack([zero, zero, one])
+    ])
+    _rotate_points_z_(tensor, rot_cos, rot_sin)
+    if with_yaw:
+        tensor[:, 6] = tensor[:, 6] - angle
+    else:
+        # the extents of the rotated corners can be obtained analytically
+        # from the sizes and the total rotation of the boxes
+        new_yaw = tensor[:, 6] - angle
+        abs_cos = torch.abs(torch.cos(new_yaw))
+        abs_sin = torch.abs(torch.sin(new_yaw))
+        x_size = tensor[:, 3]
+        y_size = tensor[:, 4]
+        tensor[:, 3:5] = torch.stack((x_size * abs_cos + y_size * abs_sin,
+                                      x_size * abs_sin + y_size * abs_cos),
+                                     dim=-1)
+    return rot_mat_T
+
+
+def _get_rot_workspace(num_boxes, dtype):
+    """Get the thread-local workspace for the NumPy rotation of boxes.
+
+    The workspace is only enlarged when more boxes are rotated than ever
+    before in the current thread.
+
+    Args:
+        num_boxes (int): Number of boxes to rotate.
+        dtype (np.dtype): Data type of the boxes.
+
+    Returns:
+        np.ndarray: Workspace in shape (num_boxes, 3).
+    """
+    workspace = getattr(_ROT_WS, 'workspace', None)
+    if workspace is None or workspace.shape[0] < num_boxes or \
+            workspace.dtype != dtype:
+        workspace = np.empty((num_boxes, 3), dtype=dtype)
+        _ROT_WS.workspace = workspace
+    return workspace[:num_boxes]
+
+
+def _rotate_np_(boxes, angle, with_yaw):
+    """In-place rotation of boxes around z axis in NumPy.
+
+    This is the NumPy counterpart of ``_rotate_tensor``, which is used for
+    CPU boxes to avoid the dispatch overhead of the small torch ops.
+
+    Args:
+        boxes (np.ndarray): Boxes in shape (N, box_dim).
+        angle (float): Rotation angle.
+        with_yaw (bool): Whether the boxes are with yaw rotation. If False,
+            the sizes of the boxes are updated to the axis-aligned extents
+            of the rotated boxes.
+
+    Returns:
+        np.ndarray: Transposed rotation matrix in shape (3, 3).
+    """
+    rot_sin = np.sin(angle)
+    rot_cos = np.cos(angle)
+    # the rotation matrix is returned to the caller (e.g., kept as
+    # `pcd_rotation` by the data pipeline), so it is not shared
+    rot_mat_T = np.array(
+        [[rot_cos, rot_sin, 0], [-rot_sin, rot_cos, 0], [0, 0, 1]],
+        dtype=boxes.dtype)
+    workspace = _get_rot_workspace(boxes.shape[0], boxes.dtype)
+    np.matmul(boxes[:, 0:3], rot_mat_T, out=workspace)
+    boxes[:, 0:3] = workspace
+    if with_yaw:
+        boxes[:, 6] -= angle
+    else:
+        new_yaw = boxes[:, 6] - angle
+        abs_cos = np.abs(np.cos(new_yaw))
+        abs_sin = np.abs(np.sin(new_yaw))
+        workspace[:, :2] = boxes[:, 3:5]
+        x_size = workspace[:, 0]
+        y_size = workspace[:, 1]
+        boxes[:, 3] = x_size * abs_cos + y_size * abs_sin
+        boxes[:, 4] = x_size * abs_sin + y_size * abs_cos
+    return rot_mat_T
 
 
 class DepthInstance3DBoxes(BaseInstance3DBoxes):
@@ -39,11 +269,7 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
         Returns:
             torch.Tensor: A tensor with center of each box.
         """
-        bottom_center = self.bottom_center
-        gravity_center = torch.zeros_like(bottom_center)
-        gravity_center[:, :2] = bottom_center[:, :2]
-        gravity_center[:, 2] = bottom_center[:, 2] + self.tensor[:, 5] * 0.5
-        return gravity_center
+        return _gravity_center_tensor(self.tensor)
 
     @property
     def corners(self):
@@ -70,23 +296,19 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
         Returns:
             torch.Tensor: Corners of each box with size (N, 8, 3).
         """
-        # TODO: rotation_3d_in_axis function do not support
-        #  empty tensor currently.
-        assert len(self.tensor) != 0
         dims = self.dims
-        corners_norm = torch.from_numpy(
-            np.stack(np.unravel_index(np.arange(8), [2] * 3), axis=1)).to(
-                device=dims.device, dtype=dims.dtype)
-
-        corners_norm = corners_norm[[0, 1, 3, 2, 4, 5, 7, 6]]
-        # use relative origin (0.5, 0.5, 0)
-        corners_norm = corners_norm - dims.new_tensor([0.5, 0.5, 0])
-        corners = dims.view([-1, 1, 3]) * corners_norm.reshape([1, 8, 3])
-
-        # rotate around z axis
-        corners = rotation_3d_in_axis(corners, self.tensor[:, 6], axis=2)
-        corners += self.tensor[:, :3].view(-1, 1, 3)
-        return corners
+        key = (dims.device, dims.dtype)
+        corners_norm = _CORNERS_NORM_CACHE.get(key)
+        if corners_norm is None:
+            # use relative origin (0.5, 0.5, 0)
+            corners_norm = torch.tensor(
+                [[-0.5, -0.5, 0], [-0.5, -0.5, 1], [-0.5, 0.5, 1],
+                 [-0.5, 0.5, 0], [0.5, -0.5, 0], [0.5, -0.5, 1], [0.5, 0.5, 1],
+                 [0.5, 0.5, 0]],
+                dtype=dims.dtype,
+                device=dims.device)
+            _CORNERS_NORM_CACHE[key] = corners_norm
+        return _corners_tensor(self.tensor, corners_norm)
 
     @property
     def bev(self):
@@ -96,7 +318,8 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
             torch.Tensor: A n x 5 tensor of 2D BEV box of each box. \
                 The box is in XYWHR format.
         """
-        return self.tensor[:, [0, 1, 3, 4, 6]]
+        return self.tensor.index_select(
+            1, _get_index((0, 1, 3, 4, 6), self.tensor.device))
 
     @property
     def nearest_bev(self):
@@ -105,22 +328,7 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
         Returns:
             torch.Tensor: A tensor of 2D BEV box of each box.
         """
-        # Obtain BEV boxes with rotation in XYWHR format
-        bev_rotated_boxes = self.bev
-        # convert the rotation to a valid range
-        rotations = bev_rotated_boxes[:, -1]
-        normed_rotations = torch.abs(limit_period(rotations, 0.5, np.pi))
-
-        # find the center of boxes
-        conditions = (normed_rotations > np.pi / 4)[..., None]
-        bboxes_xywh = torch.where(conditions, bev_rotated_boxes[:,
-                                                                [0, 1, 3, 2]],
-                                  bev_rotated_boxes[:, :4])
-
-        centers = bboxes_xywh[:, :2]
-        dims = bboxes_xywh[:, 2:]
-        bev_boxes = torch.cat([centers - dims / 2, centers + dims / 2], dim=-1)
-        return bev_boxes
+        return _nearest_bev_tensor(self.tensor)
 
     def rotate(self, angle, points=None):
         """Rotate boxes with points (optional) with the given angle.
@@ -134,30 +342,34 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
             tuple or None: When ``points`` is None, the function returns \
                 None, otherwise it returns the rotated points and the \
                 rotation matrix ``rot_mat_T``.
+
+        Note:
+            CPU boxes are rotated in place through their NumPy view
+            unless the boxes or the angle require grad. Such writes do not
+            bump the version counter of ``self.tensor``, so if the tensor
+            has been saved for backward by another op, autograd will not
+            raise the usual in-place modification error. Rotate a clone of
+            the boxes in that case.
         """
-        if not isinstance(angle, torch.Tensor):
-            angle = self.tensor.new_tensor(angle)
-        rot_sin = torch.sin(angle)
-        rot_cos = torch.cos(angle)
-        rot_mat_T = self.tensor.new_tensor([[rot_cos, -rot_sin, 0],
-                                            [rot_sin, rot_cos, 0], [0, 0,
-                                                                    1]]).T
-        self.tensor[:, 0:3] = self.tensor[:, 0:3] @ rot_mat_T
-        if self.with_yaw:
-            self.tensor[:, 6] -= angle
+        if self.tensor.device.type == 'cpu' and \
+                not self.tensor.requires_grad and \
+                not (isinstance(angle, torch.Tensor) and angle.requires_grad):
+            # rotate CPU boxes in place through their NumPy view, which
+            # is cheaper than the torch ops in data pipelines
+            rot_mat_T = torch.from_numpy(
+                _rotate_np_(self.tensor.numpy(), float(angle), self.with_yaw))
         else:
-            corners_rot = self.corners @ rot_mat_T
-            new_x_size = corners_rot[..., 0].max(
-                dim=1, keepdim=True)[0] - corners_rot[..., 0].min(
-                    dim=1, keepdim=True)[0]
-            new_y_size = corners_rot[..., 1].max(
-                dim=1, keepdim=True)[0] - corners_rot[..., 1].min(
-                    dim=1, keepdim=True)[0]
-            self.tensor[:, 3:5] = torch.cat((new_x_size, new_y_size), dim=-1)
+            # the rotation matrix follows the shape and device of the
+            # angle, so take it as a scalar on the device of the boxes
+            if isinstance(angle, torch.Tensor):
+                angle = angle.to(self.tensor).reshape(())
+            else:
+                angle = self.tensor.new_tensor(angle)
+            rot_mat_T = _rotate_tensor(self.tensor, angle, self.with_yaw)
 
         if points is not None:
             if isinstance(points, torch.Tensor):
-                points[:, :3] = points[:, :3] @ rot_mat_T
+                _rotate_points_z_(points, rot_mat_T[0, 0], rot_mat_T[0, 1])
             elif isinstance(points, np.ndarray):
                 rot_mat_T = rot_mat_T.numpy()
                 points[:, :3] = np.dot(points[:, :3], rot_mat_T)
@@ -179,14 +391,22 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
             torch.Tensor, numpy.ndarray or None: Flipped points.
         """
         assert bev_direction in ('horizontal', 'vertical')
-        if bev_direction == 'horizontal':
-            self.tensor[:, 0::7] = -self.tensor[:, 0::7]
-            if self.with_yaw:
-                self.tensor[:, 6] = -self.tensor[:, 6] + np.pi
-        elif bev_direction == 'vertical':
-            self.tensor[:, 1::7] = -self.tensor[:, 1::7]
+        key = (bev_direction, self.with_yaw, self.tensor.shape[1],
+               self.tensor.device, self.tensor.dtype)
+        flip_sign = _FLIP_SIGN_CACHE.get(key)
+        if flip_sign is None:
+            flip_sign = self.tensor.new_ones(self.tensor.shape[1])
+            if bev_direction == 'horizontal':
+                flip_sign[0::7] = -1
+            elif bev_direction == 'vertical':
+                flip_sign[1::7] = -1
             if self.with_yaw:
-                self.tensor[:, 6] = -self.tensor[:, 6]
+                flip_sign[6] = -1
+            _FLIP_SIGN_CACHE[key] = flip_sign
+        # negate the flipped coordinates (and the yaw) in a single pass
+        self.tensor.mul_(flip_sign)
+        if bev_direction == 'horizontal' and self.with_yaw:
+            self.tensor[:, 6] += np.pi
 
         if points is not None:
             assert isinstance(points, (torch.Tensor, np.ndarray))
@@ -212,10 +432,14 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
             torch.Tensor: Indicating whether each box is inside \
                 the reference range.
         """
-        in_range_flags = ((self.tensor[:, 0] > box_range[0])
-                          & (self.tensor[:, 1] > box_range[1])
-                          & (self.tensor[:, 0] < box_range[2])
-                          & (self.tensor[:, 1] < box_range[3]))
+        if isinstance(box_range, torch.Tensor):
+            box_range = box_range.to(self.tensor)
+        else:
+            box_range = self.tensor.new_tensor(box_range)
+        # compare x and y against the lower and upper bounds at once
+        bev_centers = self.tensor[:, :2]
+        in_range_flags = ((bev_centers > box_range[:2])
+                          & (bev_centers < box_range[2:4])).all(dim=1)
         return in_range_flags
 
     def convert_to(self, dst, rt_mat=None):
@@ -240,27 +464,73 @@ class DepthInstance3DBoxes(BaseInstance3DBoxes):
     def points_in_boxes(self, points):
         """Find points that are in boxes (CUDA).
 
+        Note:
+            The CUDA op is designed for LiDAR coordinates. Since Depth and
+            LiDAR coordinates only differ in a rotation around z axis,
+            under which the test of the op is invariant, Depth points and
+            boxes are fed to it directly without converting them.
+
         Args:
             points (torch.Tensor): Points in shape [1, M, 3] or [M, 3], \
-                3 dimensions are [x, y, z] in LiDAR coordinate.
+                3 dimensions are [x, y, z] in Depth coordinate.
 
         Returns:
             torch.Tensor: The index of boxes each point lies in with shape \
-                of (B, M, T).
+                of (M, T).
         """
-        from .box_3d_mode import Box3DMode
-
-        # to lidar
-        points_lidar = points.clone()
-        points_lidar = points_lidar[..., [1, 0, 2]]
-        points_lidar[..., 1] *= -1
-        if points.dim() == 2:
-            points_lidar = points_lidar.unsqueeze(0)
+        if points.dim() == 3:
+            assert points.shape[0] == 1
+            points = points[0]
         else:
-            assert points.dim() == 3 and points_lidar.shape[0] == 1
+            assert points.dim() == 2
 
-        boxes_lidar = self.convert_to(Box3DMode.LIDAR).tensor
-        boxes_lidar = boxes_lidar.to(points.device).unsqueeze(0)
-        box_idxs_of_pts = points_in_boxes_batch(points_lidar, boxes_lidar)
+        # CPU points are moved to the device of the boxes for the CUDA op
+        device = points.device if points.is_cuda else self.device
+        box_idxs_of_pts = points_in_boxes_batch(
+            points[:, :3].to(device).unsqueeze(0),
+            self.tensor[:, :7].to(device).unsqueeze(0))
 
         return box_idxs_of_pts.squeeze(0)
+
+    @classmethod
+    def points_in_boxes_many(cls, boxes_list, points_list):
+        """Find points that are in boxes of multiple frames (CUDA).
+
+        The boxes and points of all the frames are padded and stacked so
+        that the CUDA op is only launched once. The padded boxes have
+        zero sizes thus no point lies in them.
+
+        Args:
+            boxes_list (list[:obj:`DepthInstance3DBoxes`]): Boxes of
+                each frame.
+            points_list (list[torch.Tensor]): Points of each frame in
+                shape [M, 3], 3 dimensions are [x, y, z] in Depth
+                coordinate.
+
+        Returns:
+            list[torch.Tensor]: The index of boxes each point lies in \
+                with shape of (M, T) for each frame.
+        """
+        assert isinstance(boxes_list, (list, tuple))
+        assert len(boxes_list) == len(points_list)
+        assert all(isinstance(boxes, cls) for boxes in boxes_list)
+        if len(boxes_list) == 0:
+            return []
+
+        device = points_list[0].device \
+            if points_list[0].is_cuda else boxes_list[0].device
+        num_points = [points.shape[0] for points in points_list]
+        num_boxes = [len(boxes) for boxes in boxes_list]
+        batch_points = torch.zeros((len(points_list), max(num_points), 3),
+                                   device=device)
+        batch_boxes = torch.zeros((len(boxes_list), max(num_boxes), 7),
+                                  device=device)
+        for i, (boxes, points) in enumerate(zip(boxes_list, points_list)):
+            batch_points[i, :num_points[i]] = points[:, :3].to(device)
+            batch_boxes[i, :num_boxes[i]] = boxes.tensor[:, :7].to(device)
+        box_idxs_of_pts = points_in_boxes_batch(batch_points, batch_boxes)
+
+        return [
+            box_idxs_of_pts[i, :num_points[i], :num_boxes[i]]
+            for i in range(len(boxes_list))
+        ]
@@ -6,6 +6,8 @@ import unittest
 from mmdet3d.core.bbox import (BaseInstance3DBoxes, Box3DMode,
                                CameraInstance3DBoxes, DepthInstance3DBoxes,
                                LiDARInstance3DBoxes)
+from mmdet3d.core.bbox.structures.depth_box3d import (_rotate_np_,
+                                                      _rotate_tensor)
 from mmdet3d.core.bbox.structures.utils import (get_box_type, limit_period,
                                                 points_cam2img,
                                                 rotation_3d_in_axis,
@@ -284,6 +286,12 @@ def test_lidar_boxes3d():
     expected_tensor = torch.tensor([1, 1, 0, 0, 0], dtype=torch.bool)
     mask = boxes.in_range_3d([0, -20, -2, 22, 2, 5])
     assert (mask == expected_tensor).all()
+    mask = boxes.in_range_3d(torch.tensor([0, -20, -2, 22, 2, 5]))
+    assert (mask == expected_tensor).all()
+    if torch.cuda.is_available():
+        mask = boxes.to('cuda').in_range_3d(
+            torch.tensor([0, -20, -2, 22, 2, 5]))
+        assert (mask.cpu() == expected_tensor).all()
 
     # test bbox indexing
     index_boxes = boxes[2:5]
@@ -757,6 +765,12 @@ def test_camera_boxes3d():
     expected_tensor = torch.tensor([1, 1, 0, 0, 0], dtype=torch.bool)
     mask = boxes.in_range_3d([-2, -5, 0, 20, 2, 22])
     assert (mask == expected_tensor).all()
+    mask = boxes.in_range_3d(torch.tensor([-2, -5, 0, 20, 2, 22]))
+    assert (mask == expected_tensor).all()
+    if torch.cuda.is_available():
+        mask = boxes.to('cuda').in_range_3d(
+            torch.tensor([-2, -5, 0, 20, 2, 22]))
+        assert (mask.cpu() == expected_tensor).all()
 
     # test properties
     assert torch.allclose(boxes.bottom_center, boxes.tensor[:, :3])
@@ -935,6 +949,13 @@ def test_depth_boxes3d():
     expected_tensor = torch.tensor([[1.0164, 1.4597, 1.9548, 3.6001],
                                     [1.9145, 3.0402, 2.7379, 3.5728]])
     assert torch.allclose(boxes_1.nearest_bev, expected_tensor, 1e-4)
+    # the x and y sizes are swapped for boxes closer to the y axis
+    swap_boxes = DepthInstance3DBoxes([[1., 2., 0., 4., 2., 1., 1.5],
+                                       [1., 2., 0., 4., 2., 1., 0.],
+                                       [1., 2., 0., 4., 2., 1., -1.8]])
+    expected_tensor = torch.tensor([[0., 0., 2., 4.], [-1., 1., 3., 3.],
+                                    [0., 0., 2., 4.]])
+    assert torch.allclose(swap_boxes.nearest_bev, expected_tensor)
     assert repr(boxes) == (
         'DepthInstance3DBoxes(\n    tensor([], size=(0, 7)))')
 
@@ -1060,9 +1081,28 @@ def test_depth_boxes3d():
     expected_tensor = torch.tensor([1, 1], dtype=torch.bool)
     mask = boxes.in_range_bev([0., -40., 70.4, 40.])
     assert (mask == expected_tensor).all()
+    mask = boxes.in_range_bev(torch.tensor([0., -40., 70.4, 40.]))
+    assert (mask == expected_tensor).all()
+    mask = boxes.in_range_bev(torch.tensor([0., -40., 1., 40.]))
+    assert (mask == torch.tensor([1, 0], dtype=torch.bool)).all()
+    if torch.cuda.is_available():
+        mask = boxes.to('cuda').in_range_bev(
+            torch.tensor([0., -40., 70.4, 40.]))
+        assert (mask.cpu() == expected_tensor).all()
     mask = boxes.nonempty()
     assert (mask == expected_tensor).all()
 
+    # test bbox in_range_3d
+    expected_tensor = torch.tensor([1, 0], dtype=torch.bool)
+    mask = boxes.in_range_3d([0., 0., 0., 2., 2., 0.5])
+    assert (mask == expected_tensor).all()
+    mask = boxes.in_range_3d(torch.tensor([0., 0., 0., 2., 2., 0.5]))
+    assert (mask == expected_tensor).all()
+    if torch.cuda.is_available():
+        mask = boxes.to('cuda').in_range_3d(
+            torch.tensor([0., 0., 0., 2., 2., 0.5]))
+        assert (mask.cpu() == expected_tensor).all()
+
     expected_tensor = torch.tensor([[[-0.1030, 0.6649, 0.1056],
                                      [-0.1030, 0.6649, 0.3852],
                                      [-0.1030, 0.9029, 0.3852],
@@ -1079,7 +1119,23 @@ def test_depth_boxes3d():
                                      [1.5112, -0.0352, 2.8302],
                                      [1.5112, 0.8986, 2.8302],
                                      [1.5112, 0.8986, 0.9383]]])
-    torch.allclose(boxes.corners, expected_tensor)
+    assert torch.allclose(boxes.corners, expected_tensor, atol=1e-4)
+
+    # test corners of boxes with yaw against rotation_3d_in_axis
+    yaw_boxes = DepthInstance3DBoxes(np_boxes)
+    dims = yaw_boxes.dims
+    corners_norm = torch.from_numpy(
+        np.stack(np.unravel_index(np.arange(8), [2] * 3), axis=1)).to(dims)
+    corners_norm = corners_norm[[0, 1, 3, 2, 4, 5, 7, 6]]
+    corners_norm = corners_norm - dims.new_tensor([0.5, 0.5, 0])
+    expected_corners = rotation_3d_in_axis(
+        dims.view(-1, 1, 3) * corners_norm.view(1, 8, 3),
+        yaw_boxes.yaw,
+        axis=2) + yaw_boxes.bottom_center.view(-1, 1, 3)
+    assert torch.allclose(yaw_boxes.corners, expected_corners, atol=1e-6)
+
+    # corners of empty boxes
+    assert DepthInstance3DBoxes([]).corners.shape == (0, 8, 3)
 
     # test points in boxes
     if torch.cuda.is_available():
@@ -1090,6 +1146,106 @@ def test_depth_boxes3d():
             dtype=torch.int32)
         assert torch.all(box_idxs_of_pts == expected_idxs_of_pts)
 
+        # test points in boxes of multiple frames
+        box_idxs_of_pts_list = DepthInstance3DBoxes.points_in_boxes_many(
+            [boxes, boxes[:1]], [points.cuda(), points[:3].cuda()])
+        assert len(box_idxs_of_pts_list) == 2
+        assert torch.all(box_idxs_of_pts_list[0] == expected_idxs_of_pts)
+        assert torch.all(
+            box_idxs_of_pts_list[1] == expected_idxs_of_pts[:3, :1])
+
+
+def test_depth_boxes3d_points_in_boxes():
+    if not torch.cuda.is_available():
+        pytest.skip('test requires GPU and torch+cuda')
+    from mmdet3d.ops import points_in_boxes_batch
+
+    # rotated boxes with x_size != y_size
+    boxes = DepthInstance3DBoxes([[0., 0., 0., 4., 1., 1., 0.3],
+                                  [5., 5., 0., 1., 3., 1., -0.7]])
+    # offsets of the points along the box axes (x_size, y_size)
+    offsets = torch.tensor([[0., 0.], [1.5, 0.], [0., 1.2], [0., 0.3],
+                            [-1.8, 0.2]])
+    points = []
+    for box in boxes.tensor:
+        rot_sin, rot_cos = torch.sin(box[6]), torch.cos(box[6])
+        x = box[0] + offsets[:, 0] * rot_cos + offsets[:, 1] * rot_sin
+        y = box[1] - offsets[:, 0] * rot_sin + offsets[:, 1] * rot_cos
+        z = box[2] + offsets.new_full((len(offsets), ), 0.5)
+        points.append(torch.stack([x, y, z], dim=-1))
+    points = torch.cat(points).cuda()
+    boxes = boxes.to('cuda')
+    expected_idxs_of_pts = torch.tensor(
+        [[1, 0], [1, 0], [0, 0], [1, 0], [1, 0], [0, 1], [0, 0], [0, 1],
+         [0, 1], [0, 0]],
+        dtype=torch.int32,
+        device='cuda')
+
+    # the result of converting points and boxes to LiDAR coordinates
+    points_lidar = points[:, [1, 0, 2]]
+    points_lidar[:, 1] *= -1
+    boxes_lidar = boxes.convert_to(Box3DMode.LIDAR).tensor
+    lidar_idxs_of_pts = points_in_boxes_batch(
+        points_lidar.unsqueeze(0), boxes_lidar.unsqueeze(0)).squeeze(0)
+    assert torch.all(lidar_idxs_of_pts == expected_idxs_of_pts)
+
+    box_idxs_of_pts = boxes.points_in_boxes(points)
+    assert torch.all(box_idxs_of_pts == lidar_idxs_of_pts)
+    box_idxs_of_pts_list = DepthInstance3DBoxes.points_in_boxes_many(
+        [boxes, boxes[1:]], [points, points[5:]])
+    assert torch.all(box_idxs_of_pts_list[0] == lidar_idxs_of_pts)
+    assert torch.all(box_idxs_of_pts_list[1] == lidar_idxs_of_pts[5:, 1:])
+
+
+def test_depth_boxes3d_rotate_parity():
+    # the NumPy path for CPU boxes and the scripted torch path of
+    # DepthInstance3DBoxes.rotate should give the same results
+    th_boxes = torch.tensor(
+        [[1.4856, 2.5299, -0.5570, 0.9385, 2.1404, 0.8954, 3.0601],
+         [2.3262, 3.3065, 0.4426, 0.8234, 0.5325, 1.0099, 2.9971],
+         [0.6121, 0.8129, 0.1056, 1.4975, 0.1693, 0.2796, 0.0000]])
+    angle = 0.3
+    for with_yaw in [True, False]:
+        np_boxes = th_boxes.clone().numpy()
+        np_rot_mat_T = _rotate_np_(np_boxes, angle, with_yaw)
+        th_rot_boxes = th_boxes.clone()
+        th_rot_mat_T = _rotate_tensor(th_rot_boxes, torch.tensor(angle),
+                                      with_yaw)
+        assert torch.allclose(
+            th_rot_boxes, torch.from_numpy(np_boxes), atol=1e-5)
+        assert torch.allclose(
+            th_rot_mat_T, torch.from_numpy(np_rot_mat_T), atol=1e-5)
+
+        # boxes requiring grad take the scripted torch path, a non-leaf
+        # tensor is used so that it can be modified in place
+        boxes = DepthInstance3DBoxes(
+            th_boxes.clone().requires_grad_() * 1, with_yaw=with_yaw)
+        points = torch.rand(5, 3)
+        expected_points = points @ torch.from_numpy(np_rot_mat_T)
+        points, _ = boxes.rotate(angle, points.clone())
+        assert torch.allclose(
+            boxes.tensor.detach(), torch.from_numpy(np_boxes), atol=1e-5)
+        assert torch.allclose(points, expected_points, atol=1e-5)
+
+        # a tensor angle of shape (1, ) still gives a (3, 3) matrix
+        boxes = DepthInstance3DBoxes(
+            th_boxes.clone().requires_grad_() * 1, with_yaw=with_yaw)
+        _, rot_mat_T = boxes.rotate(torch.tensor([angle]), torch.rand(5, 3))
+        assert rot_mat_T.shape == (3, 3)
+        assert torch.allclose(
+            rot_mat_T, torch.from_numpy(np_rot_mat_T), atol=1e-5)
+
+        # an angle requiring grad also takes the torch path so that the
+        # rotated boxes stay connected to it
+        boxes = DepthInstance3DBoxes(th_boxes.clone(), with_yaw=with_yaw)
+        grad_angle = torch.tensor(angle, requires_grad=True)
+        boxes.rotate(grad_angle)
+        assert boxes.tensor.grad_fn is not None
+        assert torch.allclose(
+            boxes.tensor.detach(), torch.from_numpy(np_boxes), atol=1e-5)
+        boxes.tensor.sum().backward()
+        assert grad_angle.grad is not None
+
 
 def test_rotation_3d_in_axis():
     points = torch.tensor([[[-0.4599, -0.0471, 0.0000],